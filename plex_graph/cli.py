@@ -5,7 +5,8 @@ import logging
 
 import click
 
-from plex_graph import data, plex
+# Default number of concurrent metadata requests made to a Plex server
+RELOAD_WORKERS: int = 16
 
 
 def setup_logging(debug: bool = False) -> None:
@@ -28,33 +29,40 @@ def plex_graph(verbose: bool) -> None:
 @click.option('-p', '--password', prompt='Plex password', hide_input=True)
 def auth(user: str, password: str) -> None:
     '''Authenticate to Plex services and discover media servers'''
+    from plex_graph import plex
     plex.account_auth(user, password)
 
 
 @click.command()
-def harvest() -> None:
+@click.option('-w', '--workers', default=RELOAD_WORKERS, show_default=True,
+              type=click.IntRange(min=1),
+              help='Concurrent metadata requests per Plex server')
+def harvest(workers: int) -> None:
     '''Gather Movie data from Plex servers'''
+    from plex_graph import data, plex
     config = plex.server_read()
-    servers = plex.get_servers(config)
+    servers = plex.get_servers(config, workers)
     config = plex.server_config_update(config, servers)
-    for server in servers:
-        logging.info('Indexing server %s', server.name)
-        movie_sections = plex.get_movie_sections(server)
-        movie_data: data.MovieData = plex.parse_movies(movie_sections)
+    movie_data: data.MovieData = plex.index_servers(servers, workers)
     data.cache_store(movie_data)
 
 
 @click.command()
 @click.option('-r', '--relationships', default=11, show_default=True,
+              type=click.IntRange(min=1),
               help='Required minimum movies to display an actor')
-def graph(relationships: int) -> None:
+@click.option('--labels/--no-labels', default=True, show_default=True,
+              help='Label nodes with movie and actor names')
+def graph(relationships: int, labels: bool) -> None:
     '''Display a graph of movie / actor relationships'''
-    data.graph(relationships)
+    from plex_graph import data
+    data.graph(relationships, labels)
 
 
 @click.command()
 def ratings() -> None:
     '''Analyze movie ratings'''
+    from plex_graph import data
     data.rating_histogram()
 
 
@@ -3,17 +3,25 @@ Playing around with pulling movie data from plex servers and graphing
 relationships between movies via actors.
 '''
 import logging
-import math
-import shelve
+import pickle
+import struct
+from collections import Counter
 from dataclasses import dataclass, field
+from itertools import chain
 from pathlib import Path
-from typing import List, Set, Tuple
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
 
-import matplotlib.pyplot as plot
-import networkx as nx
+import zstandard
 
-SHELVE_PATH: Path = Path.home().joinpath('.cache', 'plex-graph')
-SHELVE_FILE: Path = SHELVE_PATH / 'movie_data'
+CACHE_PATH: Path = Path.home().joinpath('.cache', 'plex-graph')
+CACHE_FILE: Path = CACHE_PATH / 'movie_data.pickle.zst'
+
+# The cache file starts with a fixed header (magic, format version)
+# followed by a single zstd compressed, pickled MovieData object.
+CACHE_HEADER: struct.Struct = struct.Struct('>4sI')
+CACHE_MAGIC: bytes = b'PXGC'
+CACHE_VERSION: int = 3
+CACHE_COMPRESSION_LEVEL: int = 3
 
 
 @dataclass(eq=True, frozen=True)
@@ -29,6 +37,13 @@ class Movie:
     actors: Tuple[str, ...] = field(default_factory=tuple)
     genres: Tuple[str, ...] = field(default_factory=tuple)
 
+    def __hash__(self) -> int:
+        # Movies are graph nodes and get hashed on every node/edge insert,
+        # hashing every field would also hash each name in the cast.
+        # Equal movies share a name and year, so this stays consistent
+        # with the generated __eq__.
+        return hash((self.name, self.year))
+
     def __str__(self) -> str:
         return f'{self.name}'
 
@@ -44,98 +59,118 @@ class MovieData:
     movies: List[Movie] = field(default_factory=list)
 
 
+def merge(movie_data: Iterable[MovieData]) -> MovieData:
+    '''Combine movie data gathered from several servers
+
+    A movie found with identical metadata on more than one server is
+    only kept once.
+    '''
+    merged: MovieData = MovieData()
+    movies: Dict[Movie, None] = {}
+    for item in movie_data:
+        merged.genres.update(item.genres)
+        merged.people.update(item.people)
+        movies.update(dict.fromkeys(item.movies))
+    merged.movies = list(movies)
+    return merged
+
+
 def cache_store(movie_data: MovieData) -> None:
     '''Store the global list of Movies, Genres, and People on disk
 
     To avoid pulling data from the plex server on each run we write
-    a python shelve file.
+    the movie data to a single compressed pickle file.
     '''
-    if not SHELVE_PATH.exists():
-        SHELVE_PATH.mkdir(parents=True)
-    # Opening with mode 'n' will always create a new, empty database
-    with shelve.open(str(SHELVE_FILE), 'n') as data:
-        data['version'] = 1
-        data['movie_data'] = movie_data
+    if not CACHE_PATH.exists():
+        CACHE_PATH.mkdir(parents=True)
+    compressor = zstandard.ZstdCompressor(level=CACHE_COMPRESSION_LEVEL)
+    # Write to a temporary file and rename it over the cache so an
+    # interrupted harvest never leaves a truncated cache behind
+    tmp_file = CACHE_FILE.with_suffix('.tmp')
+    with tmp_file.open(mode='wb') as cache:
+        cache.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+        with compressor.stream_writer(cache, closefd=False) as stream:
+            pickle.dump(movie_data, stream, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_file.replace(CACHE_FILE)
 
 
 def cache_read() -> MovieData:
     '''Read the global list of Movies, Genres, and People from disk
 
     To avoid pulling data from the plex server on each run we use
-    a python shelve file to persist data between runs.
+    a compressed pickle file to persist data between runs.
     '''
-    movie_data: MovieData = MovieData()
-    with shelve.open(str(SHELVE_FILE), 'r') as data:
-        if 'version' in data:
-            logging.debug('Found version:%d data', data['version'])
-            if data['version'] == 1:
-                movie_data = data['movie_data']
-                return movie_data
-        raise RuntimeError(f'Unknown data format, remove {SHELVE_FILE} '
-                           'and regenerate data')
+    with CACHE_FILE.open(mode='rb') as cache:
+        header = cache.read(CACHE_HEADER.size)
+        if len(header) == CACHE_HEADER.size:
+            magic, version = CACHE_HEADER.unpack(header)
+            if magic == CACHE_MAGIC:
+                logging.debug('Found version:%d data', version)
+                if version == CACHE_VERSION:
+                    decompressor = zstandard.ZstdDecompressor()
+                    with decompressor.stream_reader(cache) as stream:
+                        movie_data: MovieData = pickle.load(stream)
+                    return movie_data
+    raise RuntimeError(f'Unknown data format, remove {CACHE_FILE} '
+                       'and regenerate data')
 
 
 def rating_histogram() -> None:
     logging.debug('Loading data from disk')
     movie_data: MovieData = cache_read()
 
-    hist = [0 for x in range(10)]
-    for movie in movie_data.movies:
-        if not movie.rating:
-            continue
-        rating = float(movie.rating)
-        rating_int = int(rating)
-        i = math.floor(rating) + (0 if ((rating - rating_int) * 10) < 5 else 1)
-        hist[i - 1] += 1
-    print('rating:   ', end='')
-    for idx in range(1, 11):
-        print(f'{idx: 4}', end='')
-    print()
-    print('#movies:  ', end='')
-    for idx in range(0, 10):
-        print(f'{hist[idx]: 4}', end='')
-    print()
-
-
-def graph(min_relations: int) -> None:
+    import numpy as np
+    ratings = np.fromiter((float(movie.rating)
+                           for movie in movie_data.movies if movie.rating),
+                          dtype=np.float32)
+    # Round half up to the nearest whole rating, bucket 1-10
+    buckets = np.clip(np.floor(ratings + 0.5).astype(np.int64) - 1, 0, 9)
+    hist = np.bincount(buckets, minlength=10).tolist()
+
+    header = 'rating:   ' + ''.join(f'{idx: 4}' for idx in range(1, 11))
+    counts = '#movies:  ' + ''.join(f'{count: 4}' for count in hist)
+    print(f'{header}\n{counts}')
+
+
+def graph(min_relations: int, labels: bool = True) -> None:
     '''Experiment with graphing Movie and Actor relationships'''
     logging.debug('Loading data from disk')
     movie_data: MovieData = cache_read()
 
     # Count the number of movies an actor appears in
-    actors = {person: 0 for person in movie_data.people}
-    for movie in movie_data.movies:
-        for actor in movie.actors:
-            actors[actor] = actors[actor] + 1
+    actors = Counter(chain.from_iterable(movie.actors
+                                         for movie in movie_data.movies))
 
-    # Drop people that are connected to less than {min_relations} movies
+    # Only keep people that are connected to {min_relations} or more movies
     # And right now that will be actors
-    drops = set()
-    for person in movie_data.people:
-        if actors[person] < min_relations:
-            drops.add(person)
+    frequent = {actor for actor, count in actors.items()
+                if count >= min_relations}
     logging.info('There are %d actors total', len(movie_data.people))
-    movie_data.people = movie_data.people - drops
+    people = frozenset(movie_data.people.intersection(frequent))
     logging.info('Dropping actors with less than %d movies leaves %d actors',
-                 min_relations, len(movie_data.people))
+                 min_relations, len(people))
+
+    # Trim each cast down to the remaining actors and only keep movies
+    # that still have an actor associated
+    trimmed = ((movie, people.intersection(movie.actors))
+               for movie in movie_data.movies)
+    kept: List[Tuple[Movie, FrozenSet[str]]] = [
+        (movie, cast) for movie, cast in trimmed if cast]
+    logging.info('Now there are only %d movies', len(kept))
+
+    # networkx and matplotlib are slow to import, load them only once the
+    # data has been read and filtered so errors are reported right away
+    import networkx as nx
 
     graph = nx.Graph(name='Movie/Actor relationships')
-    for person in movie_data.people:
-        graph.add_node(person)
-
-    movie_count = 0
-    for movie in movie_data.movies:
-        relation_found = False
-        for actor in movie.actors:
-            if actor in movie_data.people:
-                if not relation_found:
-                    # Only add a movie if we'll have an actor associated
-                    movie_count += 1
-                    graph.add_node(movie)
-                    relation_found = True
-                graph.add_edge(movie, actor)
-    logging.info('Now there are only %d movies', movie_count)
-
-    logging.info(nx.classes.function.info(graph))
-    nx.draw(graph, node_color='r', edge_color='b', with_labels=True)
+    graph.add_nodes_from(people)
+    graph.add_nodes_from(movie for movie, _ in kept)
+    graph.add_edges_from((movie, actor)
+                         for movie, cast in kept for actor in cast)
+
+    logging.info('%s', graph)
+    import matplotlib.pyplot as plot
+    # Edges are drawn as one LineCollection, per-node text labels are
+    # the slow part of drawing a large graph
+    nx.draw(graph, node_color='r', edge_color='b', with_labels=labels)
     plot.show()
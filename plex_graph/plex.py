@@ -3,24 +3,39 @@ Playing around with pulling movie data from plex servers and graphing
 relationships between movies via actors.
 '''
 import ast
+import json
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 from typing import List, Optional, Set
 
 import plexapi
 import requests
 from plexapi.library import LibrarySection
+from plexapi.media import MediaTag
 from plexapi.myplex import MyPlexAccount, MyPlexResource
 from plexapi.server import PlexServer
+from plexapi.video import Video
+from requests.adapters import HTTPAdapter
 
-from plex_graph.data import Movie, MovieData
-from plex_graph.exceptions import PlexUserAuthFailure, UnknownFailure
+from plex_graph.data import Movie, MovieData, merge
+from plex_graph.exceptions import (
+    NetworkFailure,
+    PlexServerAuthFailure,
+    PlexUserAuthFailure,
+    UnknownFailure,
+)
 
 CONFIG_PATH: Path = Path.home().joinpath('.config', 'plex-graph')
 CONFIG_FILE: Path = CONFIG_PATH / 'plex_servers'
 
+# Number of library items requested per page when listing a section
+LISTING_PAGE_SIZE: int = 500
+
 
 @dataclass()
 class PlexServerConfig:
@@ -61,7 +76,8 @@ def account_auth(user: str, password: str) -> None:
     for server in servers:
         logging.debug('Retrieved connection data for server "%s"', server.name)
         config[f'server:{server.name}'] = {
-            'baseurls': str([conn.httpuri for conn in server.connections]),
+            'baseurls': json.dumps([conn.httpuri
+                                    for conn in server.connections]),
             'token': server.accessToken,
         }
     server_config_write(config)
@@ -75,52 +91,93 @@ def server_read() -> ConfigParser:
     return config
 
 
-def get_servers(config: ConfigParser) -> List[PlexServerConfig]:
-    '''Connect to plex servers from our config'''
+def parse_baseurls(baseurls: str) -> List[str]:
+    '''Parse the list of server URLs stored in the config file
+
+    URLs are stored as a JSON list, older config files stored the
+    Python repr of the list.
+    '''
+    try:
+        urls: List[str] = json.loads(baseurls)
+    except json.JSONDecodeError:
+        urls = ast.literal_eval(baseurls)
+    return urls
+
+
+def _connect(url: str, token: str,
+             session: requests.Session) -> Optional[PlexServer]:
+    '''Connect to a plex server at url, returns None if unreachable
+
+    Raises plexapi.exceptions.Unauthorized if the server rejects the token.
+    '''
+    try:
+        logging.debug('Trying %s', url)
+        return PlexServer(baseurl=url, token=token, session=session,
+                          timeout=5)
+    except plexapi.exceptions.Unauthorized:
+        # Not a connection problem, let the caller report it
+        raise
+    except (requests.exceptions.RequestException,
+            plexapi.exceptions.PlexApiException) as excp:
+        # A failed probe is only a miss, another URL may still connect
+        logging.debug('No connection via %s: %s', url, excp)
+        return None
+
+
+def get_servers(config: ConfigParser,
+                workers: int) -> List[PlexServerConfig]:
+    '''Connect to plex servers from our config
+
+    The connection pool of each server is sized for {workers}
+    concurrent requests.
+    '''
     servers: List[PlexServerConfig] = []
-    for key in list(config.keys()):
+    for key in config.sections():
         if key.startswith('server:'):
-            name = key.split(':')[1]
-            urls: List[str] = ast.literal_eval(config[key]['baseurls'])
-            server = PlexServerConfig(name=name, urls=urls,
-                                      token=config[key]['token'])
-            if 'lasturl' in config[key]:
-                server.lasturl = config[key]['lasturl']
-            servers.append(server)
+            section = config[key]
+            servers.append(PlexServerConfig(
+                name=key.split(':')[1],
+                urls=parse_baseurls(section['baseurls']),
+                token=section['token'],
+                lasturl=section.get('lasturl')))
 
+    # Share one HTTP session so connections are kept alive and reused
+    # across URL attempts and all later requests to the servers.  Size the
+    # pool so every concurrent reload can keep its connection open.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     for server in servers:
         logging.info('Connecting to server %s', server.name)
-        connection = None
 
-        # See if the last used URL works
+        # Probe the last used URL and all other URLs at the same time so
+        # dead URLs don't each cost a full timeout, the first to connect wins
+        candidates = [url for url in server.urls if url != server.lasturl]
         if server.lasturl:
+            candidates.insert(0, server.lasturl)
+        executor = ThreadPoolExecutor(max_workers=max(len(candidates), 1))
+        futures = {executor.submit(_connect, url, server.token, session): url
+                   for url in candidates}
+        token_rejected = False
+        for future in as_completed(futures):
             try:
-                logging.debug('Trying %s', server.lasturl)
-                connection = PlexServer(baseurl=server.lasturl,
-                                        token=server.token,
-                                        timeout=5)
-                server.connection = connection
+                connection = future.result()
+            except plexapi.exceptions.Unauthorized:
+                logging.debug('Token rejected via %s', futures[future])
+                token_rejected = True
                 continue
-            except requests.exceptions.ConnectTimeout:
-                logging.debug('No connection via %s', server.lasturl)
-
-        # Try connecting to all possible URLs
-        for url in server.urls:
-            # Skip retrying lasturl
-            if server.lasturl:
-                if url == server.lasturl:
-                    continue
-            try:
-                logging.debug('Trying %s', url)
-                connection = PlexServer(baseurl=url,
-                                        token=server.token,
-                                        timeout=5)
-                server.lasturl = url
+            if connection:
+                server.lasturl = futures[future]
                 server.connection = connection
                 break
-            except requests.exceptions.ConnectTimeout:
-                logging.debug('No connection via %s', url)
-        if not connection:
+        # Don't wait for the remaining probes to time out
+        executor.shutdown(wait=False)
+        if not server.connection:
+            if token_rejected:
+                raise PlexServerAuthFailure(
+                    f'Plex server {server.name} rejected the stored token, '
+                    'run "plex-graph auth" again')
             logging.info('No connection could be made to %s', server.name)
     return servers
 
@@ -153,56 +210,82 @@ def get_movie_sections(server: PlexServer) -> List[LibrarySection]:
     Returns a list of plexapi.library.MovieSection objects
     '''
     movie_sections = [section for section in
-                      server.connection.library.sections()
+                      server.library.sections()
                       if section.title == 'Movies']
     logging.debug('Found movie section(s) %s', movie_sections)
     return movie_sections
 
 
-def parse_movies(movie_sections: List[LibrarySection]) -> MovieData:
+def _reload(media: Video) -> Video:
+    '''Fetch the full metadata for a library item'''
+    media.reload()
+    return media
+
+
+def parse_movies(movie_sections: List[LibrarySection], server_name: str,
+                 workers: int) -> MovieData:
     '''Parse all movies in the list of movie library sections.
 
-    Populate the global list of movies, genres, and people from Plex
+    Populate the global list of movies, genres, and people from Plex,
+    fetching metadata for up to {workers} movies at a time.  Progress is
+    logged with {server_name} as servers are parsed concurrently.
     '''
     movie_data: MovieData = MovieData()
 
+    # The same names appear across many movies and servers, intern them
+    # so there is one str per name
+    def tags(media_tags: List[MediaTag]) -> Set[str]:
+        return {sys.intern(tag.tag) for tag in media_tags}
+
     movie_count = 1
-    for section in movie_sections:
-        movie_total = len(section.all())
-        for media in section.all():
-            logging.info('Processing(%d/%d) "%s"',
-                         movie_count, movie_total, media.title)
-            movie_count += 1
-            media.reload()  # Get full object metadata
-            writers: Set[str] = set()
-            for person in media.writers:
-                person = person.tag
-                movie_data.people.add(person)
-                writers.add(person)
-            directors: Set[str] = set()
-            for person in media.directors:
-                person = person.tag
-                movie_data.people.add(person)
-                directors.add(person)
-            actors: Set[str] = set()
-            for person in media.roles:
-                person = person.tag
-                movie_data.people.add(person)
-                actors.add(person)
-            genres: Set[str] = set()
-            for genre in media.genres:
-                genre = genre.tag
-                movie_data.genres.add(genre)
-                genres.add(genre)
-            movie_data.movies.append(
-                Movie(name=media.title,
-                      year=int(media.year or 1900),
-                      studio=media.studio,
-                      content_rating=media.contentRating,
-                      rating=media.rating,
-                      writers=tuple(writers),
-                      directors=tuple(directors),
-                      actors=tuple(actors),
-                      genres=tuple(genres),
-                      ))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for section in movie_sections:
+            items = section.all(container_size=LISTING_PAGE_SIZE)
+            movie_total = len(items)
+            # Fetching full metadata is a round trip per movie, so run
+            # the reloads concurrently and parse results as they arrive
+            for media in executor.map(_reload, items):
+                logging.info('%s: Processing(%d/%d) "%s"', server_name,
+                             movie_count, movie_total, media.title)
+                movie_count += 1
+                writers = tags(media.writers)
+                directors = tags(media.directors)
+                actors = tags(media.roles)
+                genres = tags(media.genres)
+                movie_data.people.update(writers, directors, actors)
+                movie_data.genres.update(genres)
+                movie_data.movies.append(
+                    Movie(name=media.title,
+                          year=int(media.year or 1900),
+                          studio=media.studio,
+                          content_rating=media.contentRating,
+                          rating=media.rating,
+                          writers=tuple(writers),
+                          directors=tuple(directors),
+                          actors=tuple(actors),
+                          genres=tuple(genres),
+                          ))
     return movie_data
+
+
+def _index_server(server: PlexServer, workers: int) -> MovieData:
+    '''Gather movie data from all movie sections of a server'''
+    logging.info('Indexing server %s', server.friendlyName)
+    return parse_movies(get_movie_sections(server), server.friendlyName,
+                        workers)
+
+
+def index_servers(servers: List[PlexServerConfig],
+                  workers: int) -> MovieData:
+    '''Gather movie data from all connected servers
+
+    Servers are indexed concurrently and their movie data merged.
+    Raises NetworkFailure if no server is connected.
+    '''
+    connected = [server.connection for server in servers
+                 if server.connection]
+    if not connected:
+        raise NetworkFailure('No connection could be made to any Plex server')
+    with ThreadPoolExecutor(max_workers=len(connected)) as executor:
+        return merge(executor.map(partial(_index_server, workers=workers),
+                                  connected))